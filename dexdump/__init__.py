@@ -1,5 +1,51 @@
+import mmap
+import os
 import struct
-import sys
+from functools import lru_cache
+
+
+_S_INT = struct.Struct("<i")
+_S_SHORT = struct.Struct("<h")
+_S_Q = struct.Struct("<Q")
+
+# per-byte continuation bits / 7-bit payloads of 8 LEB128 bytes loaded as one little-endian word
+_LEB128_CONT_MASK = 0x8080808080808080
+_LEB128_PAYLOAD_MASK = 0x7f7f7f7f7f7f7f7f
+
+
+def _read_leb128_at(mm, pos):
+    """
+    :param mm: buffer to decode from
+    :param pos: position of a LEB128 value in the buffer
+    :return: the decoded value and the position just past it
+    """
+    if pos + 8 <= len(mm):
+        # decode from one 8-byte word: the lowest clear continuation bit marks the final byte
+        word = _S_Q.unpack_from(mm, pos)[0]
+        stop = ~word & _LEB128_CONT_MASK
+        last = stop & -stop
+        length = last.bit_length() >> 3
+        if not stop or length > 5:
+            raise Exception("LEB128 sequence invalid")
+        payload = word & ((last << 1) - 1) & _LEB128_PAYLOAD_MASK
+        return ((payload & 0x7f) | ((payload >> 1) & 0x3f80) | ((payload >> 2) & 0x1fc000) |
+                ((payload >> 3) & 0xfe00000) | ((payload >> 4) & 0x7f0000000)), pos + length
+    result = 0
+    for shift in (0, 7, 14, 21, 28):
+        current = mm[pos]
+        pos += 1
+        result |= (current & 0x7f) << shift
+        if current < 0x80:
+            return result, pos
+    raise Exception("LEB128 sequence invalid")
+
+
+@lru_cache(maxsize=None)
+def _ints_struct(count):
+    """
+    :return: (cached) compiled struct for unpacking count little-endian ints
+    """
+    return struct.Struct("<%di" % count)
 
 
 class ByteStream(object):
@@ -7,79 +53,137 @@ class ByteStream(object):
     Class to read from little-endian formatted bytestream
     """
 
-    LITTLE_ENDIAN_INT_FORMAT = "<i"
-    LITTLE_ENDIAN_SHORT_FORMAT = "<h"
-    LITTLE_ENDIAN_LONG_LONG_FORMAT = "<Q"
-
-    def __init__(self, path):
-        self._path = path
-        self._file = open(self._path, 'r+b')
-        self._look_ahead = None
-        self._look_ahead_pos = None
-        self._look_ahead_index = None
+    def __init__(self, path_or_buffer):
+        """
+        :param path_or_buffer: path to file to read, or its full contents as any buffer-protocol object
+          (`bytes`, `bytearray` and `mmap` are read in place; others, such as `memoryview`, are copied to `bytes`
+          once, since reading strings needs the buffer's `find`); a `bytearray` cannot be resized until `close`
+        """
+        if isinstance(path_or_buffer, (str, os.PathLike)):
+            self._path = path_or_buffer
+            with open(self._path, 'rb') as f:
+                # map the whole file read-only; reads are slices of the mapping
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._path = None
+            if isinstance(path_or_buffer, (bytes, bytearray, mmap.mmap)):
+                self._mm = path_or_buffer
+            else:
+                self._mm = memoryview(path_or_buffer).tobytes()
+        # one long-lived view over the whole buffer, so slicing it never copies or re-exports the buffer
+        self._view = memoryview(self._mm)
+        self._pos = 0
+        # memoized parses of items at fixed offsets, keyed (offset, count, clazz) -> (items, end position);
+        # single items from `parse_one_item` are keyed with a count of None
+        self._items_cache = {}
+        # decoded strings, keyed by their data offset within the file
+        self._desc_cache = {}
 
     def __enter__(self):
         return self
 
     def __exit__(self, *_):
-        self._file.close()
+        self.close()
         return False
 
+    def close(self):
+        """
+        release the file mapping (a no-op for in-memory buffers)
+        """
+        self._view.release()
+        if self._path is not None:
+            self._mm.close()
+
     def read_byte(self):
-        if sys.version_info >= (3,):
-            return self._file.read(1)[0]
-        else:
-            return ord(self._file.read(1)[0])
+        pos = self._pos
+        self._pos = pos + 1
+        return self._mm[pos]
 
     def read_short(self):
-        return struct.unpack(ByteStream.LITTLE_ENDIAN_SHORT_FORMAT, self._file.read(2))[0]
+        pos = self._pos
+        self._pos = pos + 2
+        return _S_SHORT.unpack_from(self._mm, pos)[0]
 
     def read_int(self):
-        return struct.unpack(ByteStream.LITTLE_ENDIAN_INT_FORMAT, self._file.read(4))[0]
+        pos = self._pos
+        self._pos = pos + 4
+        return _S_INT.unpack_from(self._mm, pos)[0]
 
     def read_ints(self, count):
-        return struct.unpack("<%di" % count, self._file.read(count * 4))
+        pos = self._pos
+        self._pos = pos + count * 4
+        return _ints_struct(count).unpack_from(self._mm, pos)
 
     def read_leb128(self):
-        result = 0
-        shift = 0
-        while True:
-            current = self.read_byte()
-            result |= ((current & 0x7f) << shift)
-            if (current & 0x80) == 0:
-                break
-            shift += 7
-            if shift >= 35:
-                raise Exception("LEB128 sequence invalid")
+        mm = self._mm
+        pos = self._pos
+        current = mm[pos]
+        if current < 0x80:
+            # fast path: the vast majority of dex LEB128 values fit in a single byte
+            self._pos = pos + 1
+            return current
+        result, self._pos = _read_leb128_at(mm, pos)
         return result
 
+    def read_leb128s(self, count):
+        """
+        :param count: number of consecutive LEB128 values to read
+        :return: list of the decoded values
+        """
+        mm = self._mm
+        pos = self._pos
+        values = [0] * count
+        for index in range(count):
+            current = mm[pos]
+            if current < 0x80:
+                values[index] = current
+                pos += 1
+            else:
+                values[index], pos = _read_leb128_at(mm, pos)
+        self._pos = pos
+        return values
+
     def read_bytes(self, byte_count):
-        return bytes(self._file.read(byte_count))
+        """
+        :return: the next byte_count bytes, as `bytes` whatever the type of the underlying buffer
+        """
+        pos = self._pos
+        self._pos = pos + byte_count
+        return bytes(self._mm[pos:pos + byte_count])
 
     def read_string(self):
-        pos = self._file.tell()
-        result = ""
-        byte_data = self._file.read(128)
-        while byte_data:
-            fmt = "<%ds" % len(byte_data)
-            delta = struct.unpack(fmt, byte_data)[0].decode('latin-1').split(chr(0))[0]
-            result += delta
-            if len(byte_data) == 128 and len(delta) == 128:
-                byte_data = self._file.read(128)
-            else:
-                byte_data = None
-        pos += len(result)
-        self._file.seek(pos)
-        return result
+        # the string runs up to its NUL terminator, or to the end of the buffer if it has none
+        mm = self._mm
+        pos = self._pos
+        end = mm.find(b'\x00', pos)
+        if end < 0:
+            end = len(mm)
+        self._pos = end
+        return mm[pos:end].decode('latin-1')
 
     def tell(self):
-        return self._file.tell()
+        return self._pos
 
     def seek(self, pos):
-        return self._file.seek(pos)
+        self._pos = pos
+        return pos
 
     def read(self, count):
-        return self._file.read(count)
+        """
+        :return: zero-copy view of the next count bytes of the mapping
+        """
+        pos = self._pos
+        self._pos = pos + count
+        return self._view[pos:pos + count]
+
+    def read_struct(self, compiled):
+        """
+        :param compiled: `struct.Struct` of the record at the current location
+        :return: the unpacked record, decoded in place from the buffer
+        """
+        pos = self._pos
+        self._pos = pos + compiled.size
+        return compiled.unpack_from(self._mm, pos)
 
     def parse_items(self, count, offset, clazz):
         """
@@ -89,22 +193,70 @@ class ByteStream(object):
         :return: collection of requested number of clazz instances parsed from bytestream
         """
         if count == 0:
-            return []
-        if offset is not None:
-            self._file.seek(offset)
-        return clazz.get(self, count)
+            return clazz.get(self, 0)
+        if offset is None:
+            # position-relative parses can't be keyed by location
+            return clazz.get(self, count)
+        key = (offset, count, clazz)
+        cached = self._items_cache.get(key)
+        if cached is not None:
+            result, self._pos = cached
+            return result
+        self._pos = offset
+        result = clazz.get(self, count)
+        self._items_cache[key] = (result, self._pos)
+        return result
 
     def parse_one_item(self, offset, clazz):
-        if offset is not None:
-            self._file.seek(offset)
-        return clazz.get(self, 1)[0]
+        """
+        :param offset: offset within file of item, or None to start at current location
+        :param clazz: `DexParser.Item` subclass to parse into
+        :return: single clazz instance parsed from bytestream (memoized, like `parse_items`, when offset is given)
+        """
+        if offset is None:
+            return clazz.get_one(self)
+        key = (offset, None, clazz)
+        cached = self._items_cache.get(key)
+        if cached is not None:
+            result, self._pos = cached
+            return result
+        self._pos = offset
+        result = clazz.get_one(self)
+        self._items_cache[key] = (result, self._pos)
+        return result
 
     def parse_descriptor(self, string_id):
-        self._file.seek(string_id.data_offset)
-        # read past unused:
-        self.read_leb128()
-        return self.read_string()
-
-    def parse_method_name(self, method_id):
-        string_id = method_id._string_ids[method_id.name_index]
-        return self.parse_descriptor(string_id)
+        return self.parse_descriptor_at(string_id.data_offset)
+
+    def parse_descriptor_at(self, offset):
+        """
+        :param offset: data offset of a string_data_item, as held by a `StringIdItem`
+        :return: the (cached) decoded string
+        """
+        result = self._desc_cache.get(offset)
+        if result is None:
+            self._pos = offset
+            # read past unused:
+            self.read_leb128()
+            result = self.read_string()
+            self._desc_cache[offset] = result
+        return result
+
+    def load_string_table(self, offsets):
+        """
+        Decode every string_data_item in one pass over the mapping, priming the descriptor cache
+        :param offsets: data offsets of all strings in the dex (from the string id table)
+        """
+        mm = self._mm
+        find = mm.find
+        table = self._desc_cache
+        for offset in offsets:
+            # skip the utf16-size LEB128 prefix, then the string runs up to its NUL terminator
+            start = offset
+            while mm[start] & 0x80:
+                start += 1
+            start += 1
+            end = find(b'\x00', start)
+            if end < 0:
+                end = len(mm)
+            table[offset] = mm[start:end].decode('latin-1')
@@ -1,15 +1,38 @@
+import array
+import itertools
 import os
-import shutil
+import struct
 import sys
-import tempfile
 import zipfile
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from dexdump import junit3
 from . import ByteStream
 
 
+def _array_typecode(code):
+    """
+    :param code: `struct` format code of a fixed-size integer field
+    :return: `array.array` typecode of the same size and signedness; the C types behind the typecodes vary in size by
+       platform, whereas the `struct` layouts (as little-endian) do not
+    :raises: `RuntimeError` if the platform has no such typecode
+    """
+    size = struct.calcsize("<" + code)
+    for typecode in ("bhilq" if code.islower() else "BHILQ"):
+        if array.array(typecode).itemsize == size:
+            return typecode
+    raise RuntimeError("No %d-byte array typecode for struct format code %s" % (size, code))
+
 class DexParser(object):
 
+    # chunk size for inflating dex entries out of an apk
+    READ_CHUNK_SIZE = 1 << 16
+
+    JUNIT4_TEST_DESCRIPTOR = "Lorg/junit/Test;"
+
+    # index value marking an absent reference, such as the super class of java.lang.Object
+    NO_INDEX = 0xFFFFFFFF
+
     class FormatException(Exception):
         pass
 
@@ -20,14 +43,14 @@ class DexParser(object):
         SIZE_MAGIC_DEX = 3
         SIZE_MAGIC_VERSION = 3
 
-        EXPECTED_DEX = bytes([0x64, 0x65, 0x78]) if sys.version_info >= (3,) else 'dex'
-        EXPECTED_VERSION = bytes([0x30, 0x33, 0x35]) if sys.version_info >= (3,) else '035'
+        EXPECTED_DEX = b'dex'
+        EXPECTED_VERSION = b'035'
 
-        def __init__(self, bytestream):
-            self._dex = bytestream.read_bytes(DexParser.DexMagic.SIZE_MAGIC_DEX)
-            self._newline = bytestream.read_byte()
-            self._version = bytestream.read_bytes(DexParser.DexMagic.SIZE_MAGIC_VERSION)
-            self._zero = bytestream.read_byte()
+        def __init__(self, dex, newline, version, zero):
+            self._dex = dex
+            self._newline = newline
+            self._version = version
+            self._zero = zero
 
         def validate(self):
             return (self._dex == DexParser.DexMagic.EXPECTED_DEX and
@@ -43,18 +66,20 @@ class DexParser(object):
         EXPECTED_ENDIAN_TAG = 0x12345678
 
         def __init__(self, bytestream):
-            self._magic = DexParser.DexMagic(bytestream)
-            self._checksum = bytestream.read_int()
-            self._signature = bytestream.read_bytes(DexParser.Header.SIZE_SIGNATURE)
+            # the whole fixed-size header is decoded with a single unpack
+            fields = bytestream.read_struct(DexParser.Header._STRUCT)
+            self._magic = DexParser.DexMagic(*fields[:4])
+            self._checksum = fields[4]
+            self._signature = fields[5]
             self._file_size, self._header_size, self._endian_tag, self._link_size, self._link_offset, \
-              self._map_offset = bytestream.read_ints(6)
+              self._map_offset = fields[6:12]
             self._size_and_offset = {}
-            for clazz in [DexParser.StringIdItem, DexParser.TypeIdItem, DexParser.ProtoIdItem,
-                          DexParser.FieldIdItem, DexParser.MethodIdItem, DexParser.ClassDefItem,
-                          DexParser.ClassDefData]:
+            sizes_and_offsets = fields[12:]
+            for index, clazz in enumerate([DexParser.StringIdItem, DexParser.TypeIdItem, DexParser.ProtoIdItem,
+                                           DexParser.FieldIdItem, DexParser.MethodIdItem, DexParser.ClassDefItem,
+                                           DexParser.ClassDefData]):
                 # define for each data class the size and offset of where that class's data is stored
-                size, offset = bytestream.read_ints(2)
-                self._size_and_offset[clazz] = (size, offset)
+                self._size_and_offset[clazz] = sizes_and_offsets[2 * index:2 * index + 2]
 
         def size_and_offset(self, clazz):
             return self._size_and_offset.get(clazz)
@@ -68,6 +93,10 @@ class DexParser(object):
             if self._endian_tag != DexParser.Header.EXPECTED_ENDIAN_TAG:
                 raise DexParser.FormatException("Invalid endian-ness/tag in dex file")
 
+    # magic, checksum, signature, six header ints and the (size, offset) pairs of the seven data sections
+    Header._STRUCT = struct.Struct("<%dsB%dsB i %ds 6i 14i" % (DexMagic.SIZE_MAGIC_DEX, DexMagic.SIZE_MAGIC_VERSION,
+                                                               Header.SIZE_SIGNATURE))
+
     ######################################################
     # Various data classes for holding dex-item data
     # These basically pull byte data out of the dex file to be interpreted into various classes of data
@@ -78,75 +107,162 @@ class DexParser(object):
         base class for all data items
         """
         __metaclass__ = ABCMeta
+        __slots__ = ()
         FORMAT = "*"
 
         def __init__(self, bytestream):
-            self._bytestream = bytestream
+            # items keep no reference to their bytestream; whatever needs it at query time takes it as an argument
+            pass
+
+        def __init_subclass__(cls, **kwargs):
+            super().__init_subclass__(**kwargs)
+            if cls.FORMAT[0] != '*':
+                # compile each fixed record layout once, when its class is defined
+                cls._STRUCT = struct.Struct("<" + cls.FORMAT)
+                cls._TYPECODES = tuple(_array_typecode(code) for code in cls.FORMAT)
 
         @classmethod
         def get(cls, bytestream, count):
-            import struct
             if cls.FORMAT[0] == '*':
                 # have variant-sized or un-type-able objects
                 return [cls(bytestream) for _ in range(count)]
             else:
-                size = struct.calcsize("<" + cls.FORMAT)
-                fmt = "<" + cls.FORMAT
-                if sys.version_info >= (3,):
-                    items = struct.iter_unpack(fmt, bytestream.read(count * size))
-                    return [cls(bytestream, item) for item in items]
-                else:
-                    return [cls(bytestream, struct.unpack(fmt, bytestream.read(size))) for _ in range(count)]
+                return DexParser.ItemTable(bytestream, cls, count, cls._read_columns(bytestream, count))
+
+        @classmethod
+        def _read_columns(cls, bytestream, count):
+            """
+            :return: one typed `array.array` per field of the count records at the current location
+            """
+            data = bytestream.read(count * cls._STRUCT.size)
+            width = len(cls.FORMAT)
+            if cls.FORMAT == cls.FORMAT[0] * width:
+                # all fields share a type: decode the whole block at once and split it with strided slices
+                values = array.array(cls._TYPECODES[0])
+                values.frombytes(data)
+                if sys.byteorder != "little":
+                    values.byteswap()
+                return tuple(values[field::width] for field in range(width))
+            columns = tuple(zip(*cls._STRUCT.iter_unpack(data))) or ((),) * width
+            return tuple(array.array(code, column) for code, column in zip(cls._TYPECODES, columns))
+
+        @classmethod
+        def get_one(cls, bytestream):
+            """
+            :return: single item parsed at the current location
+            """
+            if cls.FORMAT[0] == '*':
+                return cls(bytestream)
+            return cls(bytestream, bytestream.read_struct(cls._STRUCT))
+
+    class ItemTable(object):
+        """
+        Read-only sequence of fixed-format items, decoded in one pass and stored column-wise
+        (one packed array per field); item objects are only constructed for the rows actually indexed
+        """
+
+        def __init__(self, bytestream, clazz, count, columns):
+            self._bytestream = bytestream
+            self._clazz = clazz
+            self._size = count
+            self._columns = columns
+            self._items = {}
+
+        def __len__(self):
+            return self._size
+
+        def __getitem__(self, index):
+            """
+            :param index: row index (negative counts back from the end), or a slice of rows
+            :return: the item at that row, or a list of the items in the slice
+            """
+            if isinstance(index, slice):
+                return [self[row] for row in range(*index.indices(self._size))]
+            if index < 0:
+                # normalize, so the sparse row cache holds at most one item per row
+                index += self._size
+            if not 0 <= index < self._size:
+                raise IndexError("%s index out of range" % self._clazz.__name__)
+            item = self._items.get(index)
+            if item is None:
+                item = self._clazz(self._bytestream, tuple(column[index] for column in self._columns))
+                self._items[index] = item
+            return item
+
+        def __iter__(self):
+            # rows are the columns zipped together; items already built by indexing are reused
+            items = self._items
+            for index, row in enumerate(zip(*self._columns)):
+                item = items.get(index)
+                if item is None:
+                    item = items[index] = self._clazz(self._bytestream, row)
+                yield item
+
+        def column(self, name):
+            """
+            :param name: name of field, as listed in the item class's FIELDS
+            :return: all values of that field, in table order
+            """
+            return self._columns[self._clazz.FIELDS.index(name)]
 
     class DescirbableItem(Item):
         __metaclass__ = ABCMeta
+        __slots__ = ()
 
         @abstractmethod
         def _type_index(self):
             pass
 
-        @property
-        def descriptor(self):
-            type_id = self._type_ids[self._type_index()]
-            string_id = self._string_ids[type_id.descriptor_index]
-            return self._bytestream.parse_descriptor(string_id)
-
-    class Annotation(Item):
-        FORMAT = "ii"
-
-        def __init__(self, bytestream, vals):
-            super(DexParser.Annotation, self).__init__(bytestream)
-            self.index, self.annotations_offset = vals
+        def resolve_descriptor(self, type_descriptors):
+            """
+            :param type_descriptors: descriptor of each type id of the dex holding this item
+            :return: the string descriptor of this item's type
+            """
+            return type_descriptors[self._type_index()]
 
     class AnnotationItem(Item):
         FORMAT = "*b*"
+        __slots__ = ("visibility", "encoded_annotation")
 
         def __init__(self, bytestream):
             super(DexParser.AnnotationItem, self).__init__(bytestream)
             self.visibility = bytestream.read_byte()
             self.encoded_annotation = bytestream.parse_one_item(None, DexParser.EncodedAnnotation)
 
-    class AnnotationOffsetItem(Item):
-        FORMAT = "i"
-
-        def __init__(self, bytestream, vals):
-            super(DexParser.AnnotationOffsetItem, self).__init__(bytestream)
-            self.annotation_offset = vals[0]
-
     class AnnotationSetItem(Item):
         FORMAT = "*i*"
+        __slots__ = ("entries",)
 
         def __init__(self, bytestream):
             super(DexParser.AnnotationSetItem, self).__init__(bytestream)
             size = bytestream.read_int()
-            self.entries = self._bytestream.parse_items(size, None, DexParser.AnnotationOffsetItem)
+            # the annotation_item offsets, as plain ints
+            self.entries = bytestream.read_ints(size)
 
         def __iter__(self):
-            for item in self.entries:
-                yield item
+            """
+            :return: iterator over the offsets of the annotation items in this set
+            """
+            return iter(self.entries)
+
+        @staticmethod
+        def read_type_indices(bytestream, offset):
+            """
+            :param offset: offset of an annotation_set_item
+            :return: type index of each annotation in the set, read directly from the underlying
+               annotation_items without parsing their elements
+            """
+            bytestream.seek(offset)
+            type_indices = []
+            for annotation_offset in bytestream.read_ints(bytestream.read_int()):
+                # skip the visibility byte; the encoded annotation starts with its type index
+                bytestream.seek(annotation_offset + 1)
+                type_indices.append(bytestream.read_leb128())
+            return type_indices
 
     class AnnotationElement(Item):
         FORMAT = "*i*"
+        __slots__ = ("name_index", "value")
 
         def __init__(self, bytestream):
             super(DexParser.AnnotationElement, self).__init__(bytestream)
@@ -155,6 +271,7 @@ class DexParser(object):
 
     class AnnotationsDirectoryItem(Item):
         FORMAT = "*i*"
+        __slots__ = ("class_annotations_offset", "field_annotations", "method_annotations", "parameter_annotations")
 
         def __init__(self, bytestream):
             super(DexParser.AnnotationsDirectoryItem, self).__init__(bytestream)
@@ -162,91 +279,87 @@ class DexParser(object):
             field_size, \
             annotated_method_size, \
             annotated_parameter_size = bytestream.read_ints(4)
-            self.field_annotations = DexParser.Annotation.get(bytestream, field_size)
-            self.method_annotations = DexParser.Annotation.get(bytestream, annotated_method_size)
-            self.parameter_annotations = DexParser.Annotation.get(bytestream, annotated_parameter_size)
-
-        def get_methods_with_annotation(self, target_descriptor, method_ids):
+            # each annotation is kept as a plain (index, annotations_offset) pair
+            self.field_annotations = self._read_pairs(bytestream, field_size)
+            self.method_annotations = self._read_pairs(bytestream, annotated_method_size)
+            self.parameter_annotations = self._read_pairs(bytestream, annotated_parameter_size)
+
+        @staticmethod
+        def _read_pairs(bytestream, count):
+            if count == 0:
+                return []
+            ints = bytestream.read_ints(count * 2)
+            return list(zip(ints[::2], ints[1::2]))
+
+        def get_methods_with_annotation(self, bytestream, target_type_indices, method_names):
             """
-            :param target_descriptor: annotation of interest, in descriptor format
-            :param method_ids: list of MethodIdItems for querying name
-            :return: all vritual methods int his directory of that ar annotated with given descriptor
+            :param bytestream: bytestream of the dex holding this directory
+            :param target_type_indices: type indices of the annotation(s) of interest
+            :param method_names: name of each method id of the dex
+            :return: set of the names of the methods in this directory annotated with one of the target annotations
             """
-            results = []
-            for annotation in self.method_annotations:
-                if annotation.annotations_offset == 0:
+            results = set()
+            read_type_indices = DexParser.AnnotationSetItem.read_type_indices
+            for index, annotations_offset in self.method_annotations:
+                if annotations_offset == 0:
                     continue
-                entries = self._bytestream.parse_one_item(annotation.annotations_offset, DexParser.AnnotationSetItem)
-                for entry in entries:
-                    item = self._bytestream.parse_one_item(entry.annotation_offset, DexParser.AnnotationItem)
-                    if target_descriptor == item.encoded_annotation.descriptor:
-                        method_id = method_ids[annotation.index]
-                        method_descriptor = self._bytestream.parse_method_name(method_id)
-                        results.append(method_descriptor)
-                        break
-            return set(results)
+                # a method matches if any annotation in its set has one of the target types
+                if not target_type_indices.isdisjoint(read_type_indices(bytestream, annotations_offset)):
+                    results.add(method_names[index])
+            return results
 
     class ClassDefItem(DescirbableItem):
-        FORMAT = "iiiiiiii"
+        FORMAT = "IIIIIIII"
+        FIELDS = ("class_index", "access_flags", "super_class_index", "interfaces_offset",
+                  "source_file_index", "annotations_offset", "class_data_offset", "static_values_offset")
+        __slots__ = FIELDS
 
         def __init__(self, bytestream, ints):
             super(DexParser.ClassDefItem, self).__init__(bytestream)
             self.class_index, self.access_flags, self.super_class_index, self.interfaces_offset, \
             self.source_file_index, self.annotations_offset, self.class_data_offset, self.static_values_offset = ints
-            self._super_type = None
-            self._descriptor = None
-            self._super_descriptor = None
 
         def _type_index(self):
             return self.class_index
 
-        def super_descriptor(self):
+        def resolve_super_descriptor(self, type_descriptors):
             """
-            :return: the string descriptor (cached) of the super class of this class def
+            :param type_descriptors: descriptor of each type id of the dex holding this class def
+            :return: the string descriptor of the super class of this class def, or None if no inheritance
             """
-            if not self._super_descriptor:
-                self._super_descriptor = self.super_type().descriptor
-            return self._super_descriptor
-
-        def super_type(self):
-            """
-            :return: type TypeIdItem of the super class or None if no inheritance
-            """
-            if self.super_class_index < 0:
+            if self.super_class_index == DexParser.NO_INDEX:
                 return None
-            return self._type_ids[self.super_class_index]
-
-        def has_direct_super_class(self, descriptors):
-            """
-            :param descriptors: list of descriptor-style class names
-            :return: whether this class inherits from one of the classes defined by the given descriptors
-            """
-            if self.super_class_index < 0:
-                return False
-            desc = self.super_descriptor()
-            return desc in descriptors
+            return type_descriptors[self.super_class_index]
 
     class ClassDefData(Item):
         FORMAT = "*"
+        __slots__ = ("static_fields", "instance_fields", "direct_methods", "virtual_methods")
 
         def __init__(self, bytestream):
             super(DexParser.ClassDefData, self).__init__(bytestream)
-            static_fields_size = bytestream.read_leb128()
-            instance_fields_size = bytestream.read_leb128()
-            direct_methods_size = bytestream.read_leb128()
-            virtual_methods_size = bytestream.read_leb128()
-            self.static_fields = bytestream.parse_items(static_fields_size, None, DexParser.EncodedField)
-            self.instance_fields = bytestream.parse_items(instance_fields_size, None, DexParser.EncodedField)
-            self.direct_methods = bytestream.parse_items(direct_methods_size, None, DexParser.EncodedMethod)
-            self.virtual_methods = bytestream.parse_items(virtual_methods_size, None, DexParser.EncodedMethod)
+            # sizes first, then every field/method entry as one batch of LEB128 values
+            static_fields_size, instance_fields_size, direct_methods_size, virtual_methods_size = \
+                bytestream.read_leb128s(4)
+            field_width = DexParser.EncodedField.WIDTH
+            method_width = DexParser.EncodedMethod.WIDTH
+            values = bytestream.read_leb128s(field_width * (static_fields_size + instance_fields_size) +
+                                             method_width * (direct_methods_size + virtual_methods_size))
+            start = 0
+            self.static_fields = DexParser.EncodedField.from_values(values, start, static_fields_size)
+            start += field_width * static_fields_size
+            self.instance_fields = DexParser.EncodedField.from_values(values, start, instance_fields_size)
+            start += field_width * instance_fields_size
+            self.direct_methods = DexParser.EncodedMethod.from_values(values, start, direct_methods_size)
+            start += method_width * direct_methods_size
+            self.virtual_methods = DexParser.EncodedMethod.from_values(values, start, virtual_methods_size)
 
     class EncodedAnnotation(DescirbableItem):
         FORMAT = "*i*"
+        __slots__ = ("type_index", "elements")
 
         def __init__(self, bytestream):
             super(DexParser.EncodedAnnotation, self).__init__(bytestream)
-            self.type_index = bytestream.read_leb128()
-            size = bytestream.read_leb128()
+            self.type_index, size = bytestream.read_leb128s(2)
             self.elements = bytestream.parse_items(size, None, DexParser.AnnotationElement)
 
         def _type_index(self):
@@ -254,27 +367,62 @@ class DexParser(object):
 
     class EncodedItem(Item):
         FORMAT = "*"
+        # number of LEB128 values per item
+        WIDTH = 2
+        __slots__ = ("index_diff", "access_flags", "index")
 
-        def __init__(self, bytestream):
+        def __init__(self, bytestream, values, index):
             super(DexParser.EncodedItem, self).__init__(bytestream)
-            self.index_diff = bytestream.read_leb128()
-            self.access_flags = bytestream.read_leb128()
+            self.index_diff, self.access_flags = values[:2]
+            # absolute field/method index, accumulated from the diffs of the preceding items in the list
+            self.index = index
+
+        @classmethod
+        def get(cls, bytestream, count):
+            return cls.from_values(bytestream.read_leb128s(count * cls.WIDTH), 0, count)
+
+        @classmethod
+        def get_one(cls, bytestream):
+            return cls.get(bytestream, 1)[0]
+
+        @classmethod
+        def from_values(cls, values, start, count):
+            """
+            :param values: decoded LEB128 values
+            :param start: position in values of the first item's first value
+            :param count: number of items in the list
+            :return: list of count items
+            """
+            items = []
+            index = 0
+            width = cls.WIDTH
+            for pos in range(start, start + count * width, width):
+                item_values = values[pos:pos + width]
+                index += item_values[0]
+                items.append(cls(None, item_values, index))
+            return items
 
     EncodedField = EncodedItem
 
     class EncodedMethod(EncodedItem):
         FORMAT = "*"
+        __slots__ = ("code_offset",)
+        WIDTH = 3
 
-        def __init__(self, bytestream):
-            super(DexParser.EncodedMethod, self).__init__(bytestream)
-            self.code_offset = bytestream.read_leb128()
+        def __init__(self, bytestream, values, index):
+            super(DexParser.EncodedMethod, self).__init__(bytestream, values, index)
+            self.code_offset = values[2]
 
-        def method_name(self, method_ids):
-            method_id = method_ids[self.index_diff]
-            return self._bytestream.parse_method_name(method_id)
+        def resolve_method_name(self, method_names):
+            """
+            :param method_names: name of each method id of the dex holding this method
+            :return: the name of this method
+            """
+            return method_names[self.index]
 
     class EncodedArray(Item):
         FORMAT = "*"
+        __slots__ = ("size", "value")
 
         def __init__(self, bytestream):
             super(DexParser.EncodedArray, self).__init__(bytestream)
@@ -301,37 +449,81 @@ class DexParser(object):
         VALUE_NULL = 0x1E
         VALUE_BOOLEAN = 0x1F
 
+        __slots__ = ("_value",)
+
         def __init__(self, bytestream):
             super(DexParser.EncodedValue, self).__init__(bytestream)
             arg_and_type = bytestream.read_byte()
             value_arg = arg_and_type >> 5
-            value_type = arg_and_type and 0x1F
+            value_type = arg_and_type & 0x1F
 
-            if value_type not in [getattr(self, name) for name in dir(self) if name.startswith("VALUE_")]:
+            reader = DexParser.EncodedValue._READERS[value_type]
+            if reader is None:
                 raise Exception("Value type invalid: %s" % value_type)
-            if value_type <= DexParser.EncodedValue.VALUE_ENUM:
-                self._value = bytestream.read_bytes(value_arg + 1)
-            elif value_type == DexParser.EncodedValue.VALUE_ARRAY:
-                size = self._bytestream.read(1)[0]
-                self._value = bytestream.parse_items(size, None, DexParser.EncodedArray)
-            elif value_type == DexParser.EncodedValue.VALUE_ANNOTATION:
-                self._value = bytestream.parse_one_item(None, DexParser.EncodedAnnotation)
-            elif value_type == DexParser.EncodedValue.VALUE_NULL:
-                self._value = bytes([])
-            elif value_type == DexParser.EncodedValue.VALUE_BOOLEAN:
-                self._value = bytestream.read_bytes(value_arg)
+            self._value = reader(bytestream, value_arg)
+
+        @staticmethod
+        def _read_sized(bytestream, value_arg):
+            return bytestream.read_bytes(value_arg + 1)
+
+        @staticmethod
+        def _read_array(bytestream, _):
+            # an encoded_array follows directly (it carries its own size)
+            return bytestream.parse_one_item(None, DexParser.EncodedArray)
+
+        @staticmethod
+        def _read_annotation(bytestream, _):
+            return bytestream.parse_one_item(None, DexParser.EncodedAnnotation)
+
+        @staticmethod
+        def _read_null(*_):
+            return bytes([])
+
+        @staticmethod
+        def _read_boolean(_, value_arg):
+            # the value is held in value_arg itself; no further bytes follow
+            return bytes([value_arg])
+
+    # readers of the value data following the (value_arg, value_type) byte, as a table indexed by every possible
+    # (5-bit) value type; None marks an invalid type
+    EncodedValue._READERS = tuple(map({
+        EncodedValue.VALUE_BYTE: EncodedValue._read_sized,
+        EncodedValue.VALUE_SHORT: EncodedValue._read_sized,
+        EncodedValue.VALUE_CHAR: EncodedValue._read_sized,
+        EncodedValue.VALUE_INT: EncodedValue._read_sized,
+        EncodedValue.VALUE_LONG: EncodedValue._read_sized,
+        EncodedValue.VALUE_FLOAT: EncodedValue._read_sized,
+        EncodedValue.VALUE_DOUBLE: EncodedValue._read_sized,
+        EncodedValue.VALUE_STRING: EncodedValue._read_sized,
+        EncodedValue.VALUE_TYPE: EncodedValue._read_sized,
+        EncodedValue.VALUE_FIELD: EncodedValue._read_sized,
+        EncodedValue.VALUE_METHOD: EncodedValue._read_sized,
+        EncodedValue.VALUE_ENUM: EncodedValue._read_sized,
+        EncodedValue.VALUE_ARRAY: EncodedValue._read_array,
+        EncodedValue.VALUE_ANNOTATION: EncodedValue._read_annotation,
+        EncodedValue.VALUE_NULL: EncodedValue._read_null,
+        EncodedValue.VALUE_BOOLEAN: EncodedValue._read_boolean,
+    }.get, range(0x20)))
 
     class MemberIdItem(Item):
-        FORMAT = "hhi"
+        FORMAT = "HHI"
+        FIELDS = ("class_index", "type_index", "name_index")
+        __slots__ = FIELDS
 
         def __init__(self, bytestream, vals):
             super(DexParser.MemberIdItem, self).__init__(bytestream)
             self.class_index, self.type_index, self.name_index = vals
 
-    FieldIdItem = MethodIdItem = MemberIdItem
+    class FieldIdItem(MemberIdItem):
+        __slots__ = ()
+
+    class MethodIdItem(MemberIdItem):
+        __slots__ = ()
 
     class ProtoIdItem(Item):
-        FORMAT = "iii"
+        FORMAT = "III"
+        FIELDS = ("shorty_index", "return_type_index", "parameters_offset")
+        __slots__ = FIELDS
 
         def __init__(self, bytestream, ints):
             super(DexParser.ProtoIdItem, self).__init__(bytestream)
@@ -340,23 +532,37 @@ class DexParser(object):
             self.parameters_offset = ints
 
     class StringIdItem(Item):
-        FORMAT = "i"
+        FORMAT = "I"
+        FIELDS = ("data_offset",)
+        __slots__ = FIELDS
 
         def __init__(self, bytestream, offset):
             super(DexParser.StringIdItem, self).__init__(bytestream)
             self.data_offset = offset[0]
 
     class TypeIdItem(Item):
-        FORMAT = "i"
+        FORMAT = "I"
+        FIELDS = ("descriptor_index",)
+        __slots__ = FIELDS
 
         def __init__(self, bytestream, index):
             super(DexParser.TypeIdItem, self).__init__(bytestream)
             self.descriptor_index = index[0]
 
-        @property
-        def descriptor(self):
-            string_id = self._string_ids[self.descriptor_index]
-            return self._bytestream.parse_descriptor(string_id)
+    class _LazyIdMap(dict):
+        """
+        Id tables of a dex, keyed by item class; each table is parsed on first access
+        """
+
+        def __init__(self, bytestream, headers):
+            super(DexParser._LazyIdMap, self).__init__()
+            self._bytestream = bytestream
+            self._headers = headers
+
+        def __missing__(self, clazz):
+            size, offset = self._headers.size_and_offset(clazz)
+            table = self[clazz] = self._bytestream.parse_items(size, offset, clazz)
+            return table
 
     #
     ##########################################################
@@ -367,90 +573,363 @@ class DexParser(object):
         parse all dex files for a given apk
         :param apk_file_name: path to apk to parse
         :param package_names: optional list of packages to filter results
-        :return: all test method names for JUnit3 and JUnit4 style tests
+        :return: set of all test method names for JUnit3 and JUnit4 style tests
         """
-        tempd = tempfile.mkdtemp()
-        tests = []
         with zipfile.ZipFile(apk_file_name, mode="r") as zf:
-            for item in [it for it in zf.filelist if it.filename.endswith('.dex')]:
-                path = os.path.join(tempd, item.filename)
-                zf.extract(item, tempd)
-                parser = DexParser(path, package_names)
-                tests += list(parser.find_junit3_tests()) + list(parser.find_junit4_tests())
-        shutil.rmtree(tempd)
+            # parse straight from the inflated bytes; no round trip through a temp dir
+            dex_items = [it for it in zf.infolist() if it.filename.endswith('.dex')]
+            if len(dex_items) <= 1:
+                return DexParser._parse_dex_entries(zf, dex_items, package_names, map)
+            # each dex is parsed on its own, so parse them on separate cores (in processes, as parsing holds the
+            # GIL); each is submitted as soon as it is inflated, overlapping inflation with parsing
+            with ProcessPoolExecutor(max_workers=min(len(dex_items), os.cpu_count() or 1)) as executor:
+                return DexParser._parse_dex_entries(zf, dex_items, package_names, executor.map)
+
+    @staticmethod
+    def _parse_dex_entries(zf, dex_items, package_names, map_function):
+        """
+        :param zf: open `zipfile.ZipFile` of the apk
+        :param dex_items: `zipfile.ZipInfo` of each dex entry in the apk
+        :param package_names: optional list of packages to filter results
+        :param map_function: `map`-like function through which each dex is parsed
+        :return: set of all test method names for JUnit3 and JUnit4 style tests in the dex entries
+        """
+        def read_entries(items):
+            return (DexParser._read_entry(zf, it) for it in items)
+
+        results = list(map_function(_parse_dex, read_entries(dex_items), itertools.repeat(package_names)))
+        tests = set().union(*(dex_tests for dex_tests, _, _ in results))
+        if len(results) > 1:
+            # a JUnit3 test class can reach its base class through classes defined in other dexes, which no single
+            # dex's search follows: search again over the classes of all dexes together, and collect the tests of
+            # any classes found only that way from the dexes defining them
+            hierarchy = {}
+            for _, _, dex_hierarchy in results:
+                hierarchy.update(dex_hierarchy)
+            junit3_classes = DexParser._find_subclasses(hierarchy, junit3.Junit3Processor.DEFAULT_DESCRIPTORS)
+            missed = [(item, frozenset(junit3_classes.intersection(dex_hierarchy).difference(found)))
+                      for item, (_, found, dex_hierarchy) in zip(dex_items, results)]
+            missed = [(item, classes) for item, classes in missed if classes]
+            if missed:
+                tests.update(*map_function(_parse_dex_classes, read_entries(item for item, _ in missed),
+                                           itertools.repeat(package_names), (classes for _, classes in missed)))
         return tests
 
+    @staticmethod
+    def _find_subclasses(hierarchy, descriptors):
+        """
+        :param hierarchy: dict of class descriptors to the descriptors of their super classes
+        :param descriptors: descriptors of the base classes
+        :return: set of the descriptors of all classes inheriting, directly or indirectly, from one of the base classes
+        """
+        subclasses = {}
+        for descriptor, super_descriptor in hierarchy.items():
+            subclasses.setdefault(super_descriptor, []).append(descriptor)
+        found = set()
+        frontier = set(descriptors)
+        while frontier:
+            frontier = {subclass for descriptor in frontier for subclass in subclasses.get(descriptor, ())} - found
+            found |= frontier
+        return found
+
+    @staticmethod
+    def _read_entry(zf, info):
+        """
+        :param zf: open `zipfile.ZipFile`
+        :param info: `zipfile.ZipInfo` of entry to read
+        :return: inflated contents of the entry, read in large chunks into one preallocated buffer
+        """
+        data = bytearray(info.file_size)
+        view = memoryview(data)
+        pos = 0
+        with zf.open(info) as src:
+            while pos < info.file_size:
+                count = src.readinto(view[pos:pos + DexParser.READ_CHUNK_SIZE])
+                if not count:
+                    raise DexParser.FormatException("Truncated zip entry %s" % info.filename)
+                pos += count
+        return data
+
+    @classmethod
+    def from_bytes(cls, data, package_names=None):
+        """
+        :param data: full contents of a dex file, as `bytes` or any other buffer-protocol object
+        :param package_names: optional list of packages to filter results
+        :return: parser over the in-memory dex data
+        """
+        return cls(data, package_names)
+
     def __init__(self, file_name, package_names=None):
+        """
+        :param file_name: path to dex file to parse, or its contents as a buffer-protocol object
+        :param package_names: optional list of packages to filter results
+        """
         self._bytestream = ByteStream(file_name)
         self._headers = DexParser.Header(self._bytestream)
         self._headers.validate()
         self._package_filters = package_names or []
-        self._ids = {}
-        for clazz in [DexParser.StringIdItem, DexParser.TypeIdItem, DexParser.ProtoIdItem,
-                      DexParser.FieldIdItem, DexParser.MethodIdItem, DexParser.ClassDefItem]:
-            size, offset = self._headers.size_and_offset(clazz)
-            self._ids[clazz] = self._bytestream.parse_items(size, offset, clazz)
-            if clazz == DexParser.TypeIdItem:
-                DexParser.Item._type_ids = self._ids[clazz]
-            elif clazz == DexParser.StringIdItem:
-                DexParser.Item._string_ids = self._ids[clazz]
+        # id tables are only parsed when first used (proto and field ids are never needed to find tests)
+        self._ids = DexParser._LazyIdMap(self._bytestream, self._headers)
+        self._bytestream.load_string_table(self._ids[DexParser.StringIdItem].column("data_offset"))
+        # flat lookup tables so descriptor/name resolution is a single list index; these resolve straight
+        # from the id columns through the string table, without materializing any id items
+        string_offsets = self._ids[DexParser.StringIdItem].column("data_offset")
+        parse_descriptor_at = self._bytestream.parse_descriptor_at
+        self._string_offsets = string_offsets
+        # interned descriptors by string id index, so descriptor sets and lookups compare by identity first
+        self._descriptor_cache = {}
+        descriptor = self.descriptor
+        self._type_descriptors = [descriptor(descriptor_index) for descriptor_index in
+                                  self._ids[DexParser.TypeIdItem].column("descriptor_index")]
+        # type ids are unique per descriptor in a dex, so this inverts the type descriptor table
+        self._descriptor_to_type_index = {descriptor: index for index, descriptor in
+                                          enumerate(self._type_descriptors)}
+        self._method_names = [parse_descriptor_at(string_offsets[name_index])
+                              for name_index in self._ids[DexParser.MethodIdItem].column("name_index")]
+        # method names per class_data_offset; a class's methods never change, so each is resolved only once
+        self._method_names_cache = {}
+        # class def rows grouped by super class type index, built on the first inheritance search
+        self._class_rows_by_super = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        release the underlying dex file mapping
+        """
+        self._bytestream.close()
+
+    def descriptor(self, string_id_index):
+        """
+        :param string_id_index: index into the string id table
+        :return: the (cached, interned) string at that index
+        """
+        result = self._descriptor_cache.get(string_id_index)
+        if result is None:
+            result = sys.intern(self._bytestream.parse_descriptor_at(self._string_offsets[string_id_index]))
+            self._descriptor_cache[string_id_index] = result
+        return result
+
+    def type_descriptor(self, type_index):
+        """
+        :param type_index: index into the type id table
+        :return: the descriptor of that type
+        """
+        return self._type_descriptors[type_index]
+
+    def _resolve_type_indices(self, descriptors):
+        """
+        :param descriptors: descriptor-style class names
+        :return: frozenset of the indices of the types in this dex with one of those descriptors
+        """
+        lookup = self._descriptor_to_type_index
+        return frozenset(lookup[descriptor] for descriptor in descriptors if descriptor in lookup)
 
     def find_classes_directly_inherited_from(self, descriptors):
         """
-        :param descriptors: descriptor-style list of class names
+        :param descriptors: descriptor-style collection of class names (not modified)
         :return: all classes that are directly inherited form one of the classes described by the descriptors
         """
-        matching_classes = []
-        fixed_set = set(descriptors)
-        for clazz in [c for c in self._ids[DexParser.ClassDefItem] if c.has_direct_super_class(fixed_set)]:
-            type_id = self._ids[DexParser.TypeIdItem][clazz.class_index]
-            matching_classes.append(clazz)
-            string_id = self._ids[DexParser.StringIdItem][type_id.descriptor_index]
-            descriptors.append(self._bytestream.parse_descriptor(string_id))
-        return matching_classes
+        super_type_indices = self._resolve_type_indices(descriptors)
+        if not super_type_indices:
+            return []
+        class_defs = self._ids[DexParser.ClassDefItem]
+        # filter on the super-class column so only matching classes are ever materialized
+        matches = map(super_type_indices.__contains__, class_defs.column("super_class_index"))
+        return [class_defs[index] for index in itertools.compress(range(len(class_defs)), matches)]
+
+    def class_hierarchy(self):
+        """
+        :return: dict of the descriptor of each class defined in this dex to the descriptor of its super class
+           (classes without a super class are left out)
+        """
+        class_defs = self._ids[DexParser.ClassDefItem]
+        type_descriptors = self._type_descriptors
+        return {type_descriptors[class_index]: type_descriptors[super_index] for class_index, super_index in
+                zip(class_defs.column("class_index"), class_defs.column("super_class_index"))
+                if super_index != DexParser.NO_INDEX}
+
+    def find_junit3_classes(self, descriptors=None):
+        """
+        :param descriptors: descriptors of the JUnit3 test base classes, defaulting to the standard JUnit3 and
+           android.test ones
+        :return: frozenset of the descriptors of the classes in this dex inheriting, directly or through classes of
+           this dex, from one of the base classes
+        """
+        if descriptors is None:
+            descriptors = junit3.Junit3Processor.DEFAULT_DESCRIPTORS
+        class_indices = self._ids[DexParser.ClassDefItem].column("class_index")
+        return frozenset(self._type_descriptors[class_indices[row]] for row in self._find_subclass_rows(descriptors))
+
+    def _find_subclass_rows(self, super_descriptors):
+        """
+        :param super_descriptors: descriptors of the base classes
+        :return: set of the rows of all class defs inheriting, directly or indirectly, from one of the base classes
+        """
+        super_type_indices = self._resolve_type_indices(super_descriptors)
+        if not super_type_indices:
+            return set()
+        class_defs = self._ids[DexParser.ClassDefItem]
+        if self._class_rows_by_super is None:
+            self._class_rows_by_super = {}
+            for row, super_index in enumerate(class_defs.column("super_class_index")):
+                self._class_rows_by_super.setdefault(super_index, []).append(row)
+        class_indices = class_defs.column("class_index")
+        rows = set()
+        # breadth-first down the inheritance tree, each level's subclasses becoming the next level's bases
+        seen = set(super_type_indices)
+        frontier = seen
+        while frontier:
+            next_frontier = set()
+            for type_index in frontier:
+                for row in self._class_rows_by_super.get(type_index, ()):
+                    rows.add(row)
+                    next_frontier.add(class_indices[row])
+            frontier = next_frontier - seen
+            seen |= frontier
+        return rows
 
     def find_method_names(self, class_def):
         """
         :param class_def: `DexParser.ClassDefItem` from which to find names
         :return: all method names for a given class def
         """
-        class_data = self._bytestream.parse_one_item(class_def.class_data_offset, DexParser.ClassDefData)
-        return [m.method_name(self._ids[DexParser.MethodIdItem]) for m in class_data.virtual_methods]
+        offset = class_def.class_data_offset
+        if offset == 0:
+            # class has no class_data_item (no fields or methods), so there is nothing to parse
+            return ()
+        names = self._method_names_cache.get(offset)
+        if names is None:
+            # parsed past the bytestream's item cache: only the names are kept
+            self._bytestream.seek(offset)
+            class_data = self._bytestream.parse_one_item(None, DexParser.ClassDefData)
+            names = tuple(m.resolve_method_name(self._method_names) for m in class_data.virtual_methods)
+            self._method_names_cache[offset] = names
+        return names
 
     @staticmethod
     def _descriptor2name(name):
         """
         :return: the name reformatted into the format expected for parameter-passing to an adb am isntrument command
         """
-        items = name[1:-1].replace('/', '.').rsplit('.', 1)
-        return "#".join(items)
+        name = name[1:-1].replace('/', '.')
+        # separate the class name from its package with a '#'
+        split = name.rfind('.')
+        return name if split < 0 else name[:split] + '#' + name[split + 1:]
 
-    def find_junit3_tests(self, descriptors=list(junit3.Junit3Processor.DEFAULT_DESCRIPTORS)):
-        test_classes = self.find_classes_directly_inherited_from(descriptors)
-        method_names = []
+    def _is_filtered_out(self, dot_sep_name):
+        """
+        :return: whether the named class is excluded by this parser's package filters
+        """
+        return bool(self._package_filters) and not any(dot_sep_name in f for f in self._package_filters)
 
-        for class_def in test_classes:
-            dot_sep_name = self._descriptor2name(class_def.descriptor)
-            if self._package_filters and all([dot_sep_name not in f for f in self._package_filters]):
-                continue
-            method_names += [m for m in self.find_method_names(class_def) if m.startswith("test")]
+    def find_junit3_tests(self, descriptors=None):
+        """
+        :param descriptors: descriptors of the JUnit3 test base classes, defaulting to the standard JUnit3 and
+           android.test ones
+        :return: set of the JUnit3 test method names of the classes inheriting from the base classes through classes
+           of this dex (`parse` also follows inheritance across the dexes of an apk)
+        """
+        if descriptors is None:
+            descriptors = junit3.Junit3Processor.DEFAULT_DESCRIPTORS
+        # snapshot, so the search is unaffected by any later change to the caller's collection
+        return self._find_tests(self._find_subclass_rows(frozenset(descriptors)), None)[0]
 
-        return set(method_names)
+    def find_junit3_tests_of(self, descriptors):
+        """
+        :param descriptors: descriptors of classes known to be JUnit3 test classes
+        :return: set of the JUnit3 test method names of those of the classes defined in this dex
+        """
+        type_indices = self._resolve_type_indices(descriptors)
+        class_indices = self._ids[DexParser.ClassDefItem].column("class_index")
+        rows = itertools.compress(range(len(class_indices)), map(type_indices.__contains__, class_indices))
+        return self._find_tests(set(rows), None)[0]
 
     def find_junit4_tests(self):
-        test_annotation_descriptor = "Lorg/junit/Test;"
-        result = []
-        for class_def in [c for c in self._ids[DexParser.ClassDefItem] if c.annotations_offset != 0]:
-            dot_sep_name = self._descriptor2name(class_def.descriptor)
-            if self._package_filters and all([dot_sep_name not in f for f in self._package_filters]):
-                continue
-            directory = self._bytestream.parse_one_item(class_def.annotations_offset,
-                                                        DexParser.AnnotationsDirectoryItem)
-            names = directory.get_methods_with_annotation(test_annotation_descriptor,
-                                                          self._ids[DexParser.MethodIdItem])
-            result += [dot_sep_name + "#" + name for name in names]
-
-        return set(result)
+        return self._find_tests(set(), DexParser.JUNIT4_TEST_DESCRIPTOR)[1]
+
+    def find_all_tests(self):
+        """
+        :return: tuple of the JUnit3 and the JUnit4 test method names, found in a single pass over the class defs
+        """
+        return self._find_tests(self._find_subclass_rows(junit3.Junit3Processor.DEFAULT_DESCRIPTORS),
+                                DexParser.JUNIT4_TEST_DESCRIPTOR)
+
+    def _find_tests(self, junit3_rows, test_annotation_descriptor):
+        """
+        :param junit3_rows: set of the class def rows of the JUnit3 test classes
+        :param test_annotation_descriptor: descriptor of the JUnit4 test annotation, or None to skip the JUnit4 search
+        :return: tuple of the JUnit3 and the JUnit4 test method names
+        """
+        junit3_tests = set()
+        junit4_tests = set()
+        # compare annotations by type index, so no descriptor is resolved in the loop
+        test_type_indices = self._resolve_type_indices([test_annotation_descriptor] if test_annotation_descriptor
+                                                       else [])
+        if not junit3_rows and not test_type_indices:
+            # dex has no JUnit3 test classes and never references the annotation, so nothing in it can be a test
+            return junit3_tests, junit4_tests
+        class_defs = self._ids[DexParser.ClassDefItem]
+        type_descriptors = self._type_descriptors
+        class_indices = class_defs.column("class_index")
+        annotations_offsets = class_defs.column("annotations_offset")
+        # select the candidate rows first, so only those are ever name-formatted, package-filtered or seeked into
+        candidates = set(junit3_rows)
+        if test_type_indices:
+            candidates.update(itertools.compress(range(len(class_defs)), annotations_offsets))
+        for index in sorted(candidates):
+            class_index = class_indices[index]
+            annotations_offset = annotations_offsets[index]
+            is_junit3 = index in junit3_rows
+            maybe_junit4 = annotations_offset != 0 and bool(test_type_indices)
+            # class names are only formatted when needed: for package filtering, or once tests are found
+            dot_sep_name = None
+            if self._package_filters:
+                dot_sep_name = self._descriptor2name(type_descriptors[class_index])
+                if self._is_filtered_out(dot_sep_name):
+                    continue
+            if is_junit3:
+                junit3_tests.update(m for m in self.find_method_names(class_defs[index]) if m.startswith("test"))
+            if maybe_junit4:
+                # parsed past the bytestream's item cache: only the matching names are kept
+                self._bytestream.seek(annotations_offset)
+                directory = self._bytestream.parse_one_item(None, DexParser.AnnotationsDirectoryItem)
+                names = directory.get_methods_with_annotation(self._bytestream, test_type_indices, self._method_names)
+                if names:
+                    if dot_sep_name is None:
+                        dot_sep_name = self._descriptor2name(type_descriptors[class_index])
+                    junit4_tests.update(dot_sep_name + "#" + name for name in names)
+
+        return junit3_tests, junit4_tests
+
+
+def _parse_dex(data, package_names):
+    """
+    :param data: full contents of a dex file
+    :param package_names: optional list of packages to filter results
+    :return: tuple of the set of all test method names for JUnit3 and JUnit4 style tests in the dex, the
+       descriptors of the JUnit3 test classes found within the dex and the dex's class hierarchy
+    """
+    with DexParser.from_bytes(data, package_names) as parser:
+        junit3_tests, junit4_tests = parser.find_all_tests()
+        junit3_tests |= junit4_tests
+        return junit3_tests, parser.find_junit3_classes(), parser.class_hierarchy()
+
+
+def _parse_dex_classes(data, package_names, descriptors):
+    """
+    :param data: full contents of a dex file
+    :param package_names: optional list of packages to filter results
+    :param descriptors: descriptors of classes known to be JUnit3 test classes
+    :return: set of the JUnit3 test method names of those of the classes defined in the dex
+    """
+    with DexParser.from_bytes(data, package_names) as parser:
+        return parser.find_junit3_tests_of(descriptors)
 
 
 def main():
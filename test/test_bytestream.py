@@ -0,0 +1,32 @@
+import array
+import unittest
+
+from dexdump import ByteStream
+
+
+class ByteStreamTest(unittest.TestCase):
+
+    def test_load_string_table(self):
+        # two string_data_items; the last runs to the end of the buffer without a NUL terminator
+        with ByteStream(b"\x03abc\x00\x02de") as bytestream:
+            bytestream.load_string_table([0, 5])
+            self.assertEqual(bytestream.parse_descriptor_at(0), "abc")
+            self.assertEqual(bytestream.parse_descriptor_at(5), "de")
+
+    def test_read_bytes(self):
+        for buffer in (b"\x01\x02\x03", bytearray(b"\x01\x02\x03"), memoryview(b"\x01\x02\x03")):
+            with ByteStream(buffer) as bytestream:
+                bytestream.seek(1)
+                value = bytestream.read_bytes(2)
+                self.assertIs(type(value), bytes)
+                self.assertEqual(value, b"\x02\x03")
+
+    def test_buffer_protocol_objects(self):
+        data = b"\x03abc\x00"
+        for buffer in (bytearray(data), memoryview(data), memoryview(b"--" + data)[2:], array.array("B", data)):
+            with ByteStream(buffer) as bytestream:
+                self.assertEqual(bytestream.parse_descriptor_at(0), "abc")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+
+from dexdump.parsing import DexParser
+
+TEST_APK = os.path.join(os.path.dirname(__file__), "resources", "test.apk")
+
+EXAMPLE_TEST_CLASS = "Lcom/linkedin/mdctest/ExampleInstrumentedTest;"
+EXAMPLE_TEST_METHODS = ("testFailStatus", "testPassStatus", "testTestButlerCleanup", "testTestButlerRotation",
+                        "testTestButlerSetImmersiveModeConfirmation", "testTestButlerSetLocationMode",
+                        "testTestButlerSetWifiState", "testZException")
+JUNIT4_TESTS = {"com.linkedin.mdctest#ExampleInstrumentedTest#" + name for name in EXAMPLE_TEST_METHODS}
+
+
+def _read_dex():
+    with zipfile.ZipFile(TEST_APK) as zf:
+        return zf.read("classes.dex")
+
+
+def _write_apk(directory, dexes):
+    """
+    :param directory: directory to write the apk into
+    :param dexes: contents of each dex of the apk, in order
+    :return: path to an apk holding the dexes as classes.dex, classes2.dex, ...
+    """
+    path = os.path.join(directory, "test.apk")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for index, dex in enumerate(dexes):
+            zf.writestr("classes%s.dex" % (index + 1 if index else ""), dex)
+    return path
+
+
+class DexParserTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dex = _read_dex()
+
+    def setUp(self):
+        self.parser = DexParser.from_bytes(self.dex)
+
+    def tearDown(self):
+        self.parser.close()
+
+    def _class_def(self, descriptor):
+        class_defs = self.parser._ids[DexParser.ClassDefItem]
+        type_index = self.parser._resolve_type_indices([descriptor])
+        for row, class_index in enumerate(class_defs.column("class_index")):
+            if class_index in type_index:
+                return class_defs[row]
+        self.fail("no class def for %s" % descriptor)
+
+    def test_parse_apk(self):
+        self.assertEqual(DexParser.parse(TEST_APK), JUNIT4_TESTS)
+
+    def test_parse_apk_with_package_filter(self):
+        self.assertEqual(DexParser.parse(TEST_APK, ["com.linkedin.mdctest#ExampleInstrumentedTest"]), JUNIT4_TESTS)
+        self.assertEqual(DexParser.parse(TEST_APK, ["org.example"]), set())
+
+    def test_parse_multidex_apk(self):
+        # more than one dex is parsed in worker processes, and their tests merged; the second dex is a copy with
+        # one test method renamed, so all but one of its tests duplicate those of the first
+        renamed = self.dex.replace(b"testZException\x00", b"testYException\x00")
+        with tempfile.TemporaryDirectory() as tempd:
+            apk = _write_apk(tempd, [self.dex, renamed])
+            self.assertEqual(DexParser.parse(apk),
+                             JUNIT4_TESTS | {"com.linkedin.mdctest#ExampleInstrumentedTest#testYException"})
+            self.assertEqual(DexParser.parse(apk, ["org.example"]), set())
+
+    def test_parse_multidex_apk_with_junit3_classes_split_across_dexes(self):
+        # DelegatingTestSuite <- DelegatingFilterableTestSuite <- NonExecutingTestSuite, with DelegatingTestSuite
+        # renamed to a JUnit3 base class (its string padded out with NULs)
+        patched = bytearray(self.dex.replace(b"Landroid/support/test/internal/runner/junit3/DelegatingTestSuite;\x00",
+                                             b"Landroid/test/ServiceTestCase;".ljust(66, b"\x00")))
+        expected = JUNIT4_TESTS | {"testAt", "testCount", "tests"}
+        size, offset = self.parser._headers.size_and_offset(DexParser.ClassDefItem)
+        intermediate = self.parser._descriptor_to_type_index[
+            "Landroid/support/test/internal/runner/junit3/DelegatingFilterableTestSuite;"]
+        split = self.parser._ids[DexParser.ClassDefItem].column("class_index").index(intermediate) + 1
+        # split the class defs after DelegatingFilterableTestSuite, by narrowing the class_defs section of each copy
+        first, second = bytearray(patched), bytearray(patched)
+        struct.pack_into("<II", first, 0x60, split, offset)
+        struct.pack_into("<II", second, 0x60, size - split, offset + split * DexParser.ClassDefItem._STRUCT.size)
+        with tempfile.TemporaryDirectory() as tempd:
+            self.assertEqual(DexParser.parse(_write_apk(tempd, [patched])), expected)
+            self.assertEqual(DexParser.parse(_write_apk(tempd, [first, second])), expected)
+
+    def test_parse_memoryview(self):
+        with DexParser.from_bytes(memoryview(self.dex)) as parser:
+            self.assertEqual(parser.find_junit4_tests(), JUNIT4_TESTS)
+
+    def test_junit4_tests(self):
+        self.assertEqual(self.parser.find_junit4_tests(), JUNIT4_TESTS)
+
+    def test_method_names_accumulate_method_index_diffs(self):
+        class_def = self._class_def(EXAMPLE_TEST_CLASS)
+        self.assertEqual(self.parser.find_method_names(class_def), EXAMPLE_TEST_METHODS)
+
+    def test_junit3_tests_through_intermediate_classes(self):
+        # DelegatingTestSuite <- DelegatingFilterableTestSuite <- NonExecutingTestSuite, where only the last
+        # declares test methods
+        base = "Landroid/support/test/internal/runner/junit3/DelegatingTestSuite;"
+        direct_names = [name for class_def in self.parser.find_classes_directly_inherited_from([base])
+                        for name in self.parser.find_method_names(class_def) if name.startswith("test")]
+        self.assertEqual(direct_names, [])
+        self.assertEqual(self.parser.find_junit3_tests([base]), {"testAt", "testCount", "tests"})
+
+    def test_junit3_tests_include_classes_without_class_data(self):
+        # every class in the dex inherits from Object, including the many without a class_data_item
+        tests = self.parser.find_junit3_tests(["Ljava/lang/Object;"])
+        self.assertEqual(len(tests), 27)
+        self.assertTrue(set(EXAMPLE_TEST_METHODS) <= tests)
+
+    def test_classes_without_class_data(self):
+        class_def = self._class_def("Landroid/support/test/annotation/Beta;")
+        self.assertEqual(class_def.class_data_offset, 0)
+        self.assertEqual(self.parser.find_method_names(class_def), ())
+
+    def test_parse_one_encoded_item(self):
+        class_def = self._class_def(EXAMPLE_TEST_CLASS)
+        bytestream = self.parser._bytestream
+        class_data = bytestream.parse_one_item(class_def.class_data_offset, DexParser.ClassDefData)
+        # the first encoded_method follows the list sizes and any encoded_fields
+        bytestream.seek(class_def.class_data_offset)
+        static_fields_size, instance_fields_size, _, _ = bytestream.read_leb128s(4)
+        bytestream.read_leb128s(DexParser.EncodedField.WIDTH * (static_fields_size + instance_fields_size))
+        method = bytestream.parse_one_item(bytestream.tell(), DexParser.EncodedMethod)
+        expected = class_data.direct_methods[0]
+        self.assertEqual((method.index, method.access_flags, method.code_offset),
+                         (expected.index, expected.access_flags, expected.code_offset))
+
+    def test_searches_keep_no_class_data_or_annotation_items(self):
+        self.parser.find_all_tests()
+        self.parser.find_junit3_tests(["Ljava/lang/Object;"])
+        cached = {clazz for _, _, clazz in self.parser._bytestream._items_cache}
+        self.assertNotIn(DexParser.ClassDefData, cached)
+        self.assertNotIn(DexParser.AnnotationsDirectoryItem, cached)
+
+    def test_default_junit3_descriptors_find_nothing(self):
+        self.assertEqual(self.parser.find_junit3_tests(), set())
+
+    def test_encoded_annotation_values(self):
+        class_def = self._class_def(EXAMPLE_TEST_CLASS)
+        bytestream = self.parser._bytestream
+        directory = bytestream.parse_one_item(class_def.annotations_offset, DexParser.AnnotationsDirectoryItem)
+        annotations = {}
+        for offset in bytestream.parse_one_item(directory.class_annotations_offset, DexParser.AnnotationSetItem):
+            annotation = bytestream.parse_one_item(offset, DexParser.AnnotationItem).encoded_annotation
+            annotations[annotation.resolve_descriptor(self.parser._type_descriptors)] = annotation.elements
+        run_with = annotations["Lorg/junit/runner/RunWith;"]
+        self.assertEqual([self.parser.descriptor(element.name_index) for element in run_with], ["value"])
+        # a VALUE_TYPE value: the little-endian type index of the runner class
+        self.assertIs(type(run_with[0].value._value), bytes)
+        runner_index = int.from_bytes(run_with[0].value._value, "little")
+        self.assertEqual(self.parser.type_descriptor(runner_index), "Landroid/support/test/runner/AndroidJUnit4;")
+
+    def test_parsers_do_not_share_state(self):
+        with tempfile.TemporaryDirectory() as tempd:
+            path = os.path.join(tempd, "classes.dex")
+            with open(path, "wb") as f:
+                f.write(self.dex)
+            # two file-backed parsers: closing the second unmaps only its own file
+            with DexParser(path) as parser:
+                DexParser(path).close()
+                self.assertEqual(parser.find_junit4_tests(), JUNIT4_TESTS)
+
+    def test_parsers_resolve_names_from_their_own_dex(self):
+        # a second dex, identical but for one renamed test method
+        renamed = self.dex.replace(b"testZException\x00", b"testYException\x00")
+        with DexParser.from_bytes(renamed) as other:
+            self.assertIn("com.linkedin.mdctest#ExampleInstrumentedTest#testYException", other.find_junit4_tests())
+            self.assertEqual(self.parser.find_junit4_tests(), JUNIT4_TESTS)
+
+    def test_item_table_indexing(self):
+        class_defs = self.parser._ids[DexParser.ClassDefItem]
+        size = len(class_defs)
+        self.assertIs(class_defs[-1], class_defs[size - 1])
+        self.assertEqual(class_defs[1:4], [class_defs[1], class_defs[2], class_defs[3]])
+        self.assertEqual(class_defs[::-1], list(class_defs)[::-1])
+        for index in (size, -size - 1):
+            with self.assertRaises(IndexError):
+                class_defs[index]
+
+    def test_class_def_resolves_through_its_parser_tables(self):
+        class_def = self._class_def(EXAMPLE_TEST_CLASS)
+        self.assertEqual(class_def.resolve_descriptor(self.parser._type_descriptors), EXAMPLE_TEST_CLASS)
+        self.assertEqual(class_def.resolve_super_descriptor(self.parser._type_descriptors), "Ljava/lang/Object;")
+        # the descriptors were properties once; those names are gone rather than silently returning methods
+        self.assertFalse(hasattr(class_def, "descriptor"))
+        self.assertFalse(hasattr(class_def, "super_descriptor"))
+
+    def test_item_table_columns_match_record_layouts(self):
+        for clazz in (DexParser.StringIdItem, DexParser.TypeIdItem, DexParser.MethodIdItem, DexParser.ClassDefItem):
+            columns = self.parser._ids[clazz]._columns
+            self.assertEqual(sum(column.itemsize for column in columns), clazz._STRUCT.size)
+
+    def test_class_without_super_class(self):
+        _, class_defs_offset = self.parser._headers.size_and_offset(DexParser.ClassDefItem)
+        patched = bytearray(self.dex)
+        # super_class_index is the third uint of the first class_def_item
+        struct.pack_into("<I", patched, class_defs_offset + 8, DexParser.NO_INDEX)
+        with DexParser.from_bytes(patched) as parser:
+            class_def = parser._ids[DexParser.ClassDefItem][0]
+            self.assertEqual(class_def.super_class_index, DexParser.NO_INDEX)
+            self.assertIsNone(class_def.resolve_super_descriptor(parser._type_descriptors))
+            inherited = parser.find_classes_directly_inherited_from(["Ljava/lang/Object;"])
+            self.assertNotIn(class_def, inherited)
+
+
+if __name__ == "__main__":
+    unittest.main()